@@ -2,8 +2,8 @@ use std::{error::Error, fmt::Display, io::Write, path::Path, time::SystemTime};
 
 use chrono::{DateTime, Utc};
 use file_rotate::{compression::Compression, suffix::AppendCount, ContentLimit, FileRotate};
-use serde::Serialize;
-use serde_json::{Map, Value};
+use serde::{Deserialize, Serialize};
+use serde_json::Value;
 
 use crate::api::{
     blend_file_from_timeline_command, create_new_checkpoint_command::create_new_checkpoint,
@@ -17,13 +17,15 @@ use crate::api::{
 pub struct ConnectResponse {
     pub branches: Vec<String>,
     pub current_branch_name: String,
-    pub checkpoints_on_this_branch: Vec<(String, String)>,
+    pub checkpoint_hashes: Vec<String>,
+    pub checkpoint_messages: Vec<String>,
     pub current_checkpoint_hash: String,
 }
 
 #[derive(Serialize)]
 pub struct CreateCheckpointResponse {
-    pub checkpoints_on_this_branch: Vec<(String, String)>,
+    pub checkpoint_hashes: Vec<String>,
+    pub checkpoint_messages: Vec<String>,
     pub current_checkpoint_hash: String,
 }
 
@@ -41,7 +43,8 @@ pub struct SwitchToNewBranchResponse {
 #[derive(Serialize)]
 pub struct SwitchBranchResponse {
     pub current_branch_name: String,
-    pub checkpoints_on_this_branch: Vec<(String, String)>,
+    pub checkpoint_hashes: Vec<String>,
+    pub checkpoint_messages: Vec<String>,
     pub current_checkpoint_hash: String,
 }
 
@@ -96,6 +99,15 @@ fn log_op(db_path: &str, operation: &str) -> anyhow::Result<()> {
     Ok(())
 }
 
+/// Lists the checkpoints on a branch as parallel hash and message columns
+fn list_checkpoint_columns(
+    db_path: &str,
+    branch_name: &str,
+) -> anyhow::Result<(Vec<String>, Vec<String>)> {
+    list_checkpoints(db_path, branch_name)
+        .map(|commits| commits.into_iter().map(|c| (c.hash, c.message)).unzip())
+}
+
 fn connect_command(db_path: DBPath, path_to_blend: PathToBlend) -> anyhow::Result<ConnectResponse> {
     let exists = std::path::Path::new(&db_path.0).exists();
 
@@ -107,14 +119,15 @@ fn connect_command(db_path: DBPath, path_to_blend: PathToBlend) -> anyhow::Resul
 
     let branches = list_braches(db_path.0)?;
     let current_branch_name = get_current_branch(db_path.0)?;
-    let checkpoints_on_this_branch = list_checkpoints(db_path.0, &current_branch_name)
-        .map(|commits| commits.into_iter().map(|c| (c.hash, c.message)).collect())?;
+    let (checkpoint_hashes, checkpoint_messages) =
+        list_checkpoint_columns(db_path.0, &current_branch_name)?;
     let current_checkpoint_hash = get_current_commit(db_path.0)?;
 
     Ok(ConnectResponse {
         branches,
         current_branch_name,
-        checkpoints_on_this_branch,
+        checkpoint_hashes,
+        checkpoint_messages,
         current_checkpoint_hash,
     })
 }
@@ -127,12 +140,13 @@ fn create_checkpoint(
     create_new_checkpoint(path_to_blend.0, db_path.0, Some(message.to_string()))?;
 
     let current_branch_name = get_current_branch(db_path.0)?;
-    let checkpoints_on_this_branch = list_checkpoints(db_path.0, &current_branch_name)
-        .map(|commits| commits.into_iter().map(|c| (c.hash, c.message)).collect())?;
+    let (checkpoint_hashes, checkpoint_messages) =
+        list_checkpoint_columns(db_path.0, &current_branch_name)?;
     let current_checkpoint_hash = get_current_commit(db_path.0)?;
 
     Ok(CreateCheckpointResponse {
-        checkpoints_on_this_branch,
+        checkpoint_hashes,
+        checkpoint_messages,
         current_checkpoint_hash,
     })
 }
@@ -170,13 +184,14 @@ fn switch_to_branch(
 ) -> anyhow::Result<SwitchBranchResponse> {
     switch_branches(db_path.0, branch_name, path_to_blend.0)?;
     let current_branch_name = get_current_branch(db_path.0)?;
-    let checkpoints_on_this_branch = list_checkpoints(db_path.0, &current_branch_name)
-        .map(|commits| commits.into_iter().map(|c| (c.hash, c.message)).collect())?;
+    let (checkpoint_hashes, checkpoint_messages) =
+        list_checkpoint_columns(db_path.0, &current_branch_name)?;
     let current_checkpoint_hash = get_current_commit(db_path.0)?;
 
     Ok(SwitchBranchResponse {
         current_branch_name,
-        checkpoints_on_this_branch,
+        checkpoint_hashes,
+        checkpoint_messages,
         current_checkpoint_hash,
     })
 }
@@ -192,13 +207,44 @@ fn delete_branch(db_path: DBPath, branch_name: &str) -> anyhow::Result<DeleteBra
     Ok(DeleteBranchResponse { branches })
 }
 
-type JsonObject = Map<String, Value>;
+/// A command sent by the Blender addon, tagged by its `command` field
+#[derive(Debug, Deserialize, PartialEq)]
+#[serde(tag = "command", rename_all = "kebab-case")]
+pub enum Command {
+    Connect {
+        db_path: String,
+        path_to_blend: String,
+    },
+    CreateCheckpoint {
+        db_path: String,
+        path_to_blend: String,
+        message: String,
+    },
+    RestoreCheckpoint {
+        db_path: String,
+        path_to_blend: String,
+        hash: String,
+    },
+    SwitchToNewBranch {
+        db_path: String,
+        branch_name: String,
+    },
+    SwitchToBranch {
+        db_path: String,
+        path_to_blend: String,
+        branch_name: String,
+    },
+    BlendFileFromTimeline {
+        db_path: String,
+    },
+    DeleteBranch {
+        db_path: String,
+        branch_name: String,
+    },
+}
 
-fn get_string_value<'a>(value: &'a JsonObject, key: &'a str) -> anyhow::Result<&'a str> {
-    value
-        .get(key)
-        .and_then(|c| c.as_str())
-        .ok_or(FFIError::MalformedMessage(format!("{} not in object", key)).into())
+pub fn parse_command(payload: &[u8]) -> anyhow::Result<Command> {
+    serde_json::from_slice(payload).map_err(|e| FFIError::MalformedMessage(format!("{}", e)).into())
 }
 
 pub fn error_json(error: FFIError) -> Value {
@@ -210,97 +256,115 @@ pub fn error_json(error: FFIError) -> Value {
     serde_json::Value::Object(object)
 }
 
-pub fn do_command(value: Value) -> anyhow::Result<String> {
-    let value = value.as_object().ok_or(FFIError::MalformedMessage(
-        "Payload should be an object".to_string(),
-    ))?;
-    let command_name = get_string_value(value, "command")?;
-
-    match command_name {
-        "connect" => {
-            let db_path = get_string_value(value, "db_path")?;
-            let path_to_blend = get_string_value(value, "path_to_blend")?;
-
-            let result = connect_command(DBPath(db_path), PathToBlend(path_to_blend))?;
-            let s = serde_json::to_string(&result)?;
-            log_op(db_path, "connect")?;
-            Ok(s)
+/// Runs the command and writes its JSON response into `out`
+pub fn do_command(command: Command, out: &mut Vec<u8>) -> anyhow::Result<()> {
+    match command {
+        Command::Connect {
+            db_path,
+            path_to_blend,
+        } => {
+            let result = connect_command(DBPath(&db_path), PathToBlend(&path_to_blend))?;
+            serde_json::to_writer(&mut *out, &result)?;
+            log_op(&db_path, "connect")?;
+            Ok(())
         }
 
-        "create-checkpoint" => {
-            let db_path = get_string_value(value, "db_path")?;
-            let path_to_blend = get_string_value(value, "path_to_blend")?;
-            let message = get_string_value(value, "message")?;
-
-            let result = create_checkpoint(DBPath(db_path), PathToBlend(path_to_blend), message)?;
-            let s = serde_json::to_string(&result)?;
+        Command::CreateCheckpoint {
+            db_path,
+            path_to_blend,
+            message,
+        } => {
+            let result =
+                create_checkpoint(DBPath(&db_path), PathToBlend(&path_to_blend), &message)?;
+            serde_json::to_writer(&mut *out, &result)?;
             let log_message = format!("create-checkpoint {message}");
-            log_op(db_path, &log_message)?;
-            Ok(s)
+            log_op(&db_path, &log_message)?;
+            Ok(())
         }
 
-        "restore-checkpoint" => {
-            let db_path = get_string_value(value, "db_path")?;
-            let path_to_blend = get_string_value(value, "path_to_blend")?;
-            let hash = get_string_value(value, "hash")?;
-
-            let result = restore_checkpoint(DBPath(db_path), PathToBlend(path_to_blend), hash)?;
-            let s = serde_json::to_string(&result)?;
+        Command::RestoreCheckpoint {
+            db_path,
+            path_to_blend,
+            hash,
+        } => {
+            let result = restore_checkpoint(DBPath(&db_path), PathToBlend(&path_to_blend), &hash)?;
+            serde_json::to_writer(&mut *out, &result)?;
             let message = format!("restore-checkpoint {hash}");
-            log_op(db_path, &message)?;
-            Ok(s)
+            log_op(&db_path, &message)?;
+            Ok(())
         }
 
-        "switch-to-new-branch" => {
-            let db_path = get_string_value(value, "db_path")?;
-            let branch_name = get_string_value(value, "branch_name")?;
-
-            let result = switch_to_new_branch(DBPath(db_path), branch_name)?;
-            let s = serde_json::to_string(&result)?;
+        Command::SwitchToNewBranch {
+            db_path,
+            branch_name,
+        } => {
+            let result = switch_to_new_branch(DBPath(&db_path), &branch_name)?;
+            serde_json::to_writer(&mut *out, &result)?;
             let message = format!("switch-to-new-branch {branch_name}");
-            log_op(db_path, &message)?;
-            Ok(s)
+            log_op(&db_path, &message)?;
+            Ok(())
         }
 
-        "switch-to-branch" => {
-            let db_path = get_string_value(value, "db_path")?;
-            let path_to_blend = get_string_value(value, "path_to_blend")?;
-            let branch_name = get_string_value(value, "branch_name")?;
-
+        Command::SwitchToBranch {
+            db_path,
+            path_to_blend,
+            branch_name,
+        } => {
             let result =
-                switch_to_branch(DBPath(db_path), PathToBlend(path_to_blend), branch_name)?;
+                switch_to_branch(DBPath(&db_path), PathToBlend(&path_to_blend), &branch_name)?;
 
-            let s = serde_json::to_string(&result)?;
+            serde_json::to_writer(&mut *out, &result)?;
             let message = format!("switch-to-branch {branch_name}");
-            log_op(db_path, &message)?;
-            Ok(s)
+            log_op(&db_path, &message)?;
+            Ok(())
         }
 
-        "blend-file-from-timeline" => {
-            let db_path = get_string_value(value, "db_path")?;
-            let result = blend_file_from_timeline(DBPath(db_path))?;
-            let s = serde_json::to_string(&result)?;
+        Command::BlendFileFromTimeline { db_path } => {
+            let result = blend_file_from_timeline(DBPath(&db_path))?;
+            serde_json::to_writer(&mut *out, &result)?;
             let message = format!("blend-file-from-timeline {db_path}");
-            log_op(db_path, &message)?;
-            Ok(s)
+            log_op(&db_path, &message)?;
+            Ok(())
         }
 
-        "delete-branch" => {
-            let db_path = get_string_value(value, "db_path")?;
-            let branch_name = get_string_value(value, "branch_name")?;
-            let result = delete_branch(DBPath(db_path), branch_name)?;
-            let s = serde_json::to_string(&result)?;
+        Command::DeleteBranch {
+            db_path,
+            branch_name,
+        } => {
+            let result = delete_branch(DBPath(&db_path), &branch_name)?;
+            serde_json::to_writer(&mut *out, &result)?;
             let message = format!("delete-branch {db_path}");
-            log_op(db_path, &message)?;
-            Ok(s)
+            log_op(&db_path, &message)?;
+            Ok(())
         }
+    }
+}
 
-        c => {
-            let resp = serde_json::to_string(&error_json(FFIError::InternalError(format!(
-                "Command {} not implemented",
-                c
-            ))))?;
-            Ok(resp)
-        }
+#[cfg(test)]
+mod test {
+    use crate::ffi::{parse_command, Command};
+
+    #[test]
+    fn test_parse_command() {
+        let command = parse_command(
+            br#"{"command": "switch-to-new-branch", "db_path": "a.blend.timeline", "branch_name": "alt"}"#,
+        )
+        .expect("Cannot parse command");
+
+        assert_eq!(
+            command,
+            Command::SwitchToNewBranch {
+                db_path: "a.blend.timeline".to_owned(),
+                branch_name: "alt".to_owned(),
+            }
+        );
+    }
+
+    #[test]
+    fn test_parse_command_rejects_malformed_messages() {
+        assert!(parse_command(br#"{"command": "push", "db_path": "a.blend.timeline"}"#).is_err());
+        assert!(
+            parse_command(br#"{"command": "connect", "db_path": "a.blend.timeline"}"#).is_err()
+        );
     }
 }
@@ -1,8 +1,6 @@
-use std::ffi::{CStr, CString};
+use std::sync::{Mutex, MutexGuard};
 
-use ffi::{do_command, error_json, FFIError};
-use libc::c_char;
-use serde_json::Value;
+use ffi::{do_command, error_json, parse_command, FFIError};
 
 pub mod api;
 pub mod blend;
@@ -10,37 +8,91 @@ pub mod db;
 
 pub mod ffi;
 
+/// The JSON response of the last `call_command`, kept around until the caller
+/// has copied all of it out
+static LAST_RESULT: Mutex<Vec<u8>> = Mutex::new(Vec::new());
+
+fn last_result() -> MutexGuard<'static, Vec<u8>> {
+    LAST_RESULT.lock().unwrap_or_else(|e| e.into_inner())
+}
+
+/// Runs a command and copies as much of its JSON response as fits into the
+/// caller's buffer. Returns the full length of the response; if it's larger
+/// than `out_capacity`, the rest can be read with `read_last_result`.
+///
 /// # Safety
 ///
 /// this public function might dereference a raw pointer
 #[no_mangle]
-pub unsafe extern "C" fn call_command(c_string_ptr: *const c_char) -> *mut c_char {
-    let bytes = unsafe { CStr::from_ptr(c_string_ptr).to_bytes() };
+pub unsafe extern "C" fn call_command(
+    payload_ptr: *const u8,
+    payload_len: usize,
+    out_ptr: *mut u8,
+    out_capacity: usize,
+) -> usize {
+    let bytes = unsafe { std::slice::from_raw_parts(payload_ptr, payload_len) };
 
-    let string = std::str::from_utf8(bytes).unwrap();
-    let data: Value = serde_json::from_str(string).unwrap();
+    // serialize straight into the shared buffer, so its capacity is reused
+    let mut last = last_result();
+    last.clear();
 
-    let result = do_command(data);
+    let result = parse_command(bytes).and_then(|command| do_command(command, &mut last));
 
-    let json_string = match result {
-        Ok(str) => str,
-        Err(e) => {
-            serde_json::to_string(&error_json(FFIError::InternalError(format!("{e}")))).unwrap()
-        }
-    };
+    if let Err(e) = result {
+        last.clear();
+        serde_json::to_writer(
+            &mut *last,
+            &error_json(FFIError::InternalError(format!("{e}"))),
+        )
+        .unwrap();
+    }
 
-    let c_string = CString::new(json_string).unwrap();
+    copy_result(&last, out_ptr, out_capacity)
+}
 
-    c_string.into_raw()
+/// # Safety
+///
+/// `out_ptr` has to point to at least `out_capacity` writable bytes
+unsafe fn copy_result(result: &[u8], out_ptr: *mut u8, out_capacity: usize) -> usize {
+    let len = result.len().min(out_capacity);
+    unsafe { std::ptr::copy_nonoverlapping(result.as_ptr(), out_ptr, len) };
+    result.len()
 }
 
+/// Copies as much of the last response as fits into the caller's buffer, and
+/// returns its full length
+///
 /// # Safety
 ///
 /// this public function might dereference a raw pointer
 #[no_mangle]
-pub unsafe extern "C" fn free_command(ptr: *mut c_char) {
-    if ptr.is_null() {
-        return;
+pub unsafe extern "C" fn read_last_result(out_ptr: *mut u8, out_capacity: usize) -> usize {
+    copy_result(&last_result(), out_ptr, out_capacity)
+}
+
+#[cfg(test)]
+mod test {
+    use crate::{call_command, read_last_result};
+
+    #[test]
+    fn test_call_command_copies_what_fits() {
+        // `{}` has no `command` tag, so the response is an error object
+        let payload = b"{}";
+        let mut small_buf = [0u8; 8];
+
+        let len =
+            unsafe { call_command(payload.as_ptr(), payload.len(), small_buf.as_mut_ptr(), 4) };
+
+        assert!(len > 4);
+        assert_eq!(&small_buf[..4], b"{\"er");
+        assert_eq!(&small_buf[4..], &[0u8; 4]);
+
+        let mut buf = vec![0u8; len];
+        let read_len = unsafe { read_last_result(buf.as_mut_ptr(), buf.len()) };
+        assert_eq!(read_len, len);
+
+        let response: serde_json::Value =
+            serde_json::from_slice(&buf).expect("Response is not valid JSON");
+        assert!(response.get("error").is_some());
     }
-    let _ = CStr::from_ptr(ptr);
 }
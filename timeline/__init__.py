@@ -1,13 +1,13 @@
 import bpy
 import bpy_extras
 from bpy.app.handlers import persistent
-import ctypes
+import functools
 import os
-import json
-import platform
-from threading import Timer
 from urllib.parse import quote_plus
 
+from . import ffi
+
+
 bl_info = {
     "name": "Blender timeline",
     "blender": (2, 80, 0),
@@ -23,12 +23,18 @@ def get_file_path():
     return bpy.data.filepath
 
 
+@functools.lru_cache(maxsize=4)
 def get_db_path(file_path):
     filename = os.path.basename(file_path)
     filename_with_ext = filename + '.timeline'
     return os.path.join(os.path.dirname(file_path), filename_with_ext)
 
 
+@persistent
+def clear_path_cache(*args):
+    get_db_path.cache_clear()
+
+
 def save_file():
     bpy.ops.file.pack_all()
     bpy.ops.wm.save_mainfile()
@@ -44,36 +50,55 @@ def refresh_file():
 
 class WaitCursor():
     def __enter__(self):
-        bpy.context.window.cursor_set("WAIT")
+        window = bpy.context.window
+        # only the address is kept, reverting the file can free the window
+        self.window_pointer = window.as_pointer()
+        window.cursor_modal_set("WAIT")
 
     def __exit__(self, *args, **kwargs):
-        pass
-
+        window = bpy.context.window
+        if window is None:
+            return
+        if window.as_pointer() == self.window_pointer:
+            window.cursor_modal_restore()
+        else:
+            # a new window comes with a fresh modal cursor stack
+            window.cursor_set("DEFAULT")
 
-LOADED_LIB_CACHE = None
 
 CONNECTED = False
 CURRENT_BRANCH = None
 CURRENT_CHECKPOINT_HASH = None
-CHECKPOINT_ITEMS = None
+CHECKPOINT_HASHES = None
+CHECKPOINT_MESSAGES = None
 BRANCH_ITEMS = None
 
 
 def set_checkpoints_from_state(context):
-    global CHECKPOINT_ITEMS
-    context.scene.checkpoint_items.clear()
-    for checkpoint in CHECKPOINT_ITEMS:
-        item = context.scene.checkpoint_items.add()
-        item.hash = checkpoint[0]
-        item.message = checkpoint[1]
+    global CURRENT_CHECKPOINT_HASH
+    global CHECKPOINT_HASHES
+    global CHECKPOINT_MESSAGES
+    checkpoint_items = context.scene.checkpoint_items
+    checkpoint_items.clear()
+    add_item = checkpoint_items.add
+    for hash, message in zip(CHECKPOINT_HASHES, CHECKPOINT_MESSAGES):
+        item = add_item()
+        item.hash = hash
+        item.message = message
+    checkpoint_items.foreach_set(
+        "is_current", [hash == CURRENT_CHECKPOINT_HASH for hash in CHECKPOINT_HASHES])
 
 
 def set_branches_from_state(context):
+    global CURRENT_BRANCH
     global BRANCH_ITEMS
-    context.scene.branch_items.clear()
+    branch_items = context.scene.branch_items
+    branch_items.clear()
+    add_item = branch_items.add
     for branch in BRANCH_ITEMS:
-        item = context.scene.branch_items.add()
-        item.name = branch
+        add_item().name = branch
+    branch_items.foreach_set(
+        "is_current", [branch == CURRENT_BRANCH for branch in BRANCH_ITEMS])
 
 
 def set_branches_checkpoints_from_state(context):
@@ -81,61 +106,27 @@ def set_branches_checkpoints_from_state(context):
     set_checkpoints_from_state(context)
 
 
-def get_lib():
-    global LOADED_LIB_CACHE
-    if LOADED_LIB_CACHE == None:
-        script_file = os.path.realpath(__file__)
-        directory = os.path.dirname(script_file)
-        
-        system = platform.system()
-        library_name = "libtimeline.dylib"  # Default to macOS
-        if system == "Windows":
-            library_name = "timeline.dll"
-        
-        rust_lib_path = os.path.join(
-            directory, library_name)
-        rust_lib = ctypes.cdll.LoadLibrary(rust_lib_path)
-        rust_lib.call_command.restype = ctypes.c_char_p
-        LOADED_LIB_CACHE = rust_lib
-
-    return LOADED_LIB_CACHE
-
-
-def unload_lib(lib):
-    dlclose_func = ctypes.CDLL(None).dlclose
-    dlclose_func.argtypes = [ctypes.c_void_p]
-    dlclose_func.restype = ctypes.c_int
-    dlclose_func(lib._handle)
-
-
-def call_lib(message):
-    payload = json.dumps(message).encode('utf-8')
-    lib = get_lib()
-    json_ptr = lib.call_command(payload)
-    json_str = ctypes.c_char_p(json_ptr).value.decode('utf-8')
-    data = json.loads(json_str)
-    lib.free_command(json_ptr)
-    return data
-
-
 class ConnectOperator(bpy.types.Operator):
     """Connect to the Timeline"""
     bl_idname = "wm.connect"
     bl_label = "Connect to the Timeline"
+    COMMAND_TEMPLATE = b'{"command":"connect","db_path":%s,"path_to_blend":%s}'
 
     def execute(self, context):
         file_path = get_file_path()
+        db_path = get_db_path(file_path)
 
-        result = call_lib({
-            'command': 'connect',
-            'db_path': get_db_path(file_path),
-            'path_to_blend': file_path
-        })
+        result = ffi.call_lib(ffi.command_payload(
+            self.COMMAND_TEMPLATE,
+            db_path,
+            file_path))
 
         if 'error' in result:
             self.report({'ERROR'}, str(result))
             return {'FINISHED'}
 
+        register_lazy_classes()
+
         global CONNECTED
         CONNECTED = True
 
@@ -148,8 +139,11 @@ class ConnectOperator(bpy.types.Operator):
         global CURRENT_CHECKPOINT_HASH
         CURRENT_CHECKPOINT_HASH = result['current_checkpoint_hash']
 
-        global CHECKPOINT_ITEMS
-        CHECKPOINT_ITEMS = result['checkpoints_on_this_branch']
+        global CHECKPOINT_HASHES
+        CHECKPOINT_HASHES = result['checkpoint_hashes']
+
+        global CHECKPOINT_MESSAGES
+        CHECKPOINT_MESSAGES = result['checkpoint_messages']
 
         set_branches_checkpoints_from_state(context)
 
@@ -160,14 +154,14 @@ class BlendFileFromTimelineOperator(bpy.types.Operator, bpy_extras.io_utils.Impo
     """Connect to the Timeline"""
     bl_idname = "wm.blend_file_from_timeline"
     bl_label = "Connect to the Timeline"
+    COMMAND_TEMPLATE = b'{"command":"blend-file-from-timeline","db_path":%s}'
 
     def execute(self, context):
         db_path = str(self.filepath)
 
-        result = call_lib({
-            'command': 'blend-file-from-timeline',
-            'db_path': db_path,
-        })
+        result = ffi.call_lib(ffi.command_payload(
+            self.COMMAND_TEMPLATE,
+            db_path))
 
         if 'error' in result:
             self.report({'ERROR'}, str(result))
@@ -182,19 +176,22 @@ class SwitchBranchesOperator(bpy.types.Operator):
     """Switch to another branch"""
     bl_idname = "wm.switch_branch_operator"
     bl_label = "Switch Branch"
+    COMMAND_TEMPLATE = (
+        b'{"command":"switch-to-branch"'
+        b',"db_path":%s,"path_to_blend":%s,"branch_name":%s}')
 
     name: bpy.props.StringProperty(name="Branch name", default="")
 
     def execute(self, context):
         with WaitCursor():
             file_path = get_file_path()
+            db_path = get_db_path(file_path)
 
-            result = call_lib({
-                'command': 'switch-to-branch',
-                'db_path': get_db_path(file_path),
-                'path_to_blend': file_path,
-                'branch_name': str(self.name)
-            })
+            result = ffi.call_lib(ffi.command_payload(
+                self.COMMAND_TEMPLATE,
+                db_path,
+                file_path,
+                str(self.name)))
 
             if 'error' in result:
                 self.report({'ERROR'}, str(result))
@@ -208,8 +205,11 @@ class SwitchBranchesOperator(bpy.types.Operator):
             global CURRENT_CHECKPOINT_HASH
             CURRENT_CHECKPOINT_HASH = result['current_checkpoint_hash']
 
-            global CHECKPOINT_ITEMS
-            CHECKPOINT_ITEMS = result['checkpoints_on_this_branch']
+            global CHECKPOINT_HASHES
+            CHECKPOINT_HASHES = result['checkpoint_hashes']
+
+            global CHECKPOINT_MESSAGES
+            CHECKPOINT_MESSAGES = result['checkpoint_messages']
 
             set_branches_checkpoints_from_state(context)
 
@@ -220,18 +220,21 @@ class NewBranchOperator(bpy.types.Operator):
     """Create a new branch"""
     bl_idname = "wm.new_branch_operator"
     bl_label = "New Branch"
+    COMMAND_TEMPLATE = (
+        b'{"command":"switch-to-new-branch"'
+        b',"db_path":%s,"branch_name":%s}')
 
     name: bpy.props.StringProperty(name="Branch name", default="")
 
     def execute(self, context):
         with WaitCursor():
             file_path = get_file_path()
+            db_path = get_db_path(file_path)
 
-            result = call_lib({
-                'command': 'switch-to-new-branch',
-                'db_path': get_db_path(file_path),
-                'branch_name': str(self.name)
-            })
+            result = ffi.call_lib(ffi.command_payload(
+                self.COMMAND_TEMPLATE,
+                db_path,
+                str(self.name)))
 
             if 'error' in result:
                 self.report({'ERROR'}, str(result))
@@ -255,18 +258,21 @@ class DeleteBranchOperator(bpy.types.Operator):
     """Delete branch"""
     bl_idname = "wm.delete_branch_operator"
     bl_label = "Delete Branch"
+    COMMAND_TEMPLATE = (
+        b'{"command":"delete-branch"'
+        b',"db_path":%s,"branch_name":%s}')
 
     name: bpy.props.StringProperty(name="Branch name", default="")
 
     def execute(self, context):
         with WaitCursor():
             file_path = get_file_path()
+            db_path = get_db_path(file_path)
 
-            result = call_lib({
-                'command': 'delete-branch',
-                'db_path': get_db_path(file_path),
-                'branch_name': str(self.name)
-            })
+            result = ffi.call_lib(ffi.command_payload(
+                self.COMMAND_TEMPLATE,
+                db_path,
+                str(self.name)))
 
             if 'error' in result:
                 self.report({'ERROR'}, str(result))
@@ -286,29 +292,34 @@ class DeleteBranchOperator(bpy.types.Operator):
 class CheckpointItem(bpy.types.PropertyGroup):
     hash: bpy.props.StringProperty(name="Hash", default="")
     message: bpy.props.StringProperty(name="Message", default="")
+    is_current: bpy.props.BoolProperty(name="Is current", default=False)
 
 
 class BranchItem(bpy.types.PropertyGroup):
     name: bpy.props.StringProperty(name="Name", default="")
+    is_current: bpy.props.BoolProperty(name="Is current", default=False)
 
 
 class RestoreOperator(bpy.types.Operator):
     """Restore a checkpoint"""
     bl_idname = "my.restore_operator"
     bl_label = "Restore"
+    COMMAND_TEMPLATE = (
+        b'{"command":"restore-checkpoint"'
+        b',"db_path":%s,"path_to_blend":%s,"hash":%s}')
 
     hash: bpy.props.StringProperty(name="Hash", default="")
 
     def execute(self, context):
         with WaitCursor():
             file_path = get_file_path()
+            db_path = get_db_path(file_path)
 
-            result = call_lib({
-                'command': 'restore-checkpoint',
-                'db_path': get_db_path(file_path),
-                'path_to_blend': file_path,
-                'hash': str(self.hash)
-            })
+            result = ffi.call_lib(ffi.command_payload(
+                self.COMMAND_TEMPLATE,
+                db_path,
+                file_path,
+                str(self.hash)))
 
             if 'error' in result:
                 self.report({'ERROR'}, str(result))
@@ -328,6 +339,7 @@ class RestoreToFileOperator(bpy.types.Operator):
     """Restore a checkpoint to a new file"""
     bl_idname = "my.restore_to_file_operator"
     bl_label = "Restore to a new file"
+    COMMAND_TEMPLATE = RestoreOperator.COMMAND_TEMPLATE
 
     hash: bpy.props.StringProperty(name="Hash", default="")
     name: bpy.props.StringProperty(name="Checkpoint name", default="")
@@ -335,17 +347,16 @@ class RestoreToFileOperator(bpy.types.Operator):
     def execute(self, context):
         with WaitCursor():
             file_path = get_file_path()
-            file_name = os.path.basename(file_path)
-            file_name = "_".join(self.name.split(" ")) + ".blend"
+            db_path = get_db_path(file_path)
+            file_name = f"{self.name.replace(' ', '_')}.blend"
             destination_file_path = os.path.join(
                 os.path.dirname(file_path), file_name)
 
-            result = call_lib({
-                'command': 'restore-checkpoint',
-                'db_path': get_db_path(file_path),
-                'path_to_blend': destination_file_path,
-                'hash': str(self.hash)
-            })
+            result = ffi.call_lib(ffi.command_payload(
+                self.COMMAND_TEMPLATE,
+                db_path,
+                destination_file_path,
+                str(self.hash)))
 
             if 'error' in result:
                 self.report({'ERROR'}, str(result))
@@ -357,25 +368,28 @@ class CreateCheckpointOperator(bpy.types.Operator):
     """Create a new checkpoint"""
     bl_idname = "my.create_checkpoint_operator"
     bl_label = "Create Checkpoint Operator"
+    COMMAND_TEMPLATE = (
+        b'{"command":"create-checkpoint"'
+        b',"db_path":%s,"path_to_blend":%s,"message":%s}')
 
     def execute(self, context):
         with WaitCursor():
             save_file()
 
             file_path = get_file_path()
+            db_path = get_db_path(file_path)
 
             self.report({'INFO'}, file_path)
-            self.report({'INFO'}, get_db_path(file_path))
+            self.report({'INFO'}, db_path)
 
             message = str(context.scene.checkpoint_message)
             context.scene.checkpoint_message = ""
 
-            result = call_lib({
-                'command': 'create-checkpoint',
-                'db_path': get_db_path(file_path),
-                'path_to_blend': file_path,
-                'message': message
-            })
+            result = ffi.call_lib(ffi.command_payload(
+                self.COMMAND_TEMPLATE,
+                db_path,
+                file_path,
+                message))
 
             if 'error' in result:
                 self.report({'ERROR'}, str(result))
@@ -384,8 +398,10 @@ class CreateCheckpointOperator(bpy.types.Operator):
             # checkpoints
             global CURRENT_CHECKPOINT_HASH
             CURRENT_CHECKPOINT_HASH = result['current_checkpoint_hash']
-            global CHECKPOINT_ITEMS
-            CHECKPOINT_ITEMS = result['checkpoints_on_this_branch']
+            global CHECKPOINT_HASHES
+            CHECKPOINT_HASHES = result['checkpoint_hashes']
+            global CHECKPOINT_MESSAGES
+            CHECKPOINT_MESSAGES = result['checkpoint_messages']
 
             set_branches_checkpoints_from_state(context)
 
@@ -400,8 +416,7 @@ class CheckpointsList(bpy.types.UIList):
     def draw_item(self, context, layout, data, item, icon, active_data, active_propname, index):
         row = layout.row()
 
-        global CURRENT_CHECKPOINT_HASH
-        icon = CHECKMARK_ICON if item.hash == CURRENT_CHECKPOINT_HASH else BLANK_ICON
+        icon = CHECKMARK_ICON if item.is_current else BLANK_ICON
         row.label(text=item.message, icon=icon)
         restore_op = row.operator(RestoreOperator.bl_idname,
                                   text="Restore")
@@ -421,8 +436,7 @@ class BranchesList(bpy.types.UIList):
     def draw_item(self, context, layout, data, item, icon, active_data, active_propname, index):
         row = layout.row()
 
-        global CURRENT_BRANCH
-        icon = CHECKMARK_ICON if item.name == CURRENT_BRANCH else BLANK_ICON
+        icon = CHECKMARK_ICON if item.is_current else BLANK_ICON
         row.label(text=item.name, icon=icon)
         switch_branches_op = row.operator(SwitchBranchesOperator.bl_idname,
                                           text="Switch to")
@@ -482,20 +496,49 @@ class TimelinePanel(bpy.types.Panel):
                         text="Reconnect")
 
 
+# needed before connecting to the Timeline
+EAGER_CLASSES = (
+    ConnectOperator,
+    BlendFileFromTimelineOperator,
+    CheckpointItem,
+    BranchItem,
+    TimelinePanel,
+)
+
+# only used once connected, registered by ConnectOperator
+LAZY_CLASSES = (
+    SwitchBranchesOperator,
+    NewBranchOperator,
+    DeleteBranchOperator,
+    RestoreOperator,
+    RestoreToFileOperator,
+    CreateCheckpointOperator,
+    CheckpointsList,
+    BranchesList,
+)
+
+LAZY_CLASSES_REGISTERED = False
+
+
+def register_lazy_classes():
+    global LAZY_CLASSES_REGISTERED
+    if LAZY_CLASSES_REGISTERED:
+        return
+
+    for cls in LAZY_CLASSES:
+        bpy.utils.register_class(cls)
+    LAZY_CLASSES_REGISTERED = True
+
+
 def register():
-    bpy.utils.register_class(ConnectOperator)
-    bpy.utils.register_class(BlendFileFromTimelineOperator)
-    bpy.utils.register_class(SwitchBranchesOperator)
-    bpy.utils.register_class(NewBranchOperator)
-    bpy.utils.register_class(DeleteBranchOperator)
-    bpy.utils.register_class(CheckpointItem)
-    bpy.utils.register_class(BranchItem)
-    bpy.utils.register_class(RestoreOperator)
-    bpy.utils.register_class(RestoreToFileOperator)
-    bpy.utils.register_class(CreateCheckpointOperator)
-    bpy.utils.register_class(CheckpointsList)
-    bpy.utils.register_class(BranchesList)
-    bpy.utils.register_class(TimelinePanel)
+    for cls in EAGER_CLASSES:
+        bpy.utils.register_class(cls)
+
+    # load the library up front, so the first Connect doesn't pay for it
+    try:
+        ffi.get_lib()
+    except OSError as e:
+        print(f"Timeline: cannot load {ffi.LIB_PATH} ({e})")
 
     # placeholders for the template list
     bpy.types.Scene.checkpoint_idx = bpy.props.IntProperty()
@@ -510,26 +553,24 @@ def register():
     bpy.types.Scene.checkpoint_message = bpy.props.StringProperty(
         name="", options={'TEXTEDIT_UPDATE'})
 
+    bpy.app.handlers.load_post.append(clear_path_cache)
+    bpy.app.handlers.save_post.append(clear_path_cache)
+
 
 def unregister():
-    global LOADED_LIB_CACHE
-    if LOADED_LIB_CACHE != None:
-        unload_lib(LOADED_LIB_CACHE)
-    del LOADED_LIB_CACHE
-
-    bpy.utils.unregister_class(ConnectOperator)
-    bpy.utils.unregister_class(BlendFileFromTimelineOperator)
-    bpy.utils.unregister_class(SwitchBranchesOperator)
-    bpy.utils.unregister_class(NewBranchOperator)
-    bpy.utils.unregister_class(DeleteBranchOperator)
-    bpy.utils.unregister_class(CheckpointItem)
-    bpy.utils.unregister_class(BranchItem)
-    bpy.utils.unregister_class(RestoreOperator)
-    bpy.utils.unregister_class(RestoreToFileOperator)
-    bpy.utils.unregister_class(CreateCheckpointOperator)
-    bpy.utils.unregister_class(CheckpointsList)
-    bpy.utils.unregister_class(BranchesList)
-    bpy.utils.unregister_class(TimelinePanel)
+    # ffi.LOADED_LIB_CACHE is kept, re-enabling the addon reuses the loaded library
+
+    global CONNECTED
+    CONNECTED = False
+
+    global LAZY_CLASSES_REGISTERED
+    if LAZY_CLASSES_REGISTERED:
+        for cls in LAZY_CLASSES:
+            bpy.utils.unregister_class(cls)
+        LAZY_CLASSES_REGISTERED = False
+
+    for cls in EAGER_CLASSES:
+        bpy.utils.unregister_class(cls)
 
     del bpy.types.Scene.checkpoint_idx
     del bpy.types.Scene.branch_idx
@@ -537,6 +578,9 @@ def unregister():
     del bpy.types.Scene.branch_items
     del bpy.types.Scene.checkpoint_message
 
+    bpy.app.handlers.load_post.remove(clear_path_cache)
+    bpy.app.handlers.save_post.remove(clear_path_cache)
+
 
 if __name__ == "__main__":
     register()
@@ -0,0 +1,66 @@
+import ctypes
+import json
+import os
+import platform
+
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    # Blender doesn't bundle orjson, fall back to the (slower) stdlib
+    def json_dumps(message):
+        return json.dumps(message).encode('utf-8')
+
+    json_loads = json.loads
+
+
+def get_library_name():
+    system = platform.system()
+    if system == "Windows":
+        return "timeline.dll"
+    if system == "Linux":
+        return "libtimeline.so"
+    return "libtimeline.dylib"  # Default to macOS
+
+
+LIB_PATH = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), get_library_name())
+
+# os.RTLD_NOW only exists on POSIX, Windows ignores the mode anyway
+LIB_LOAD_MODE = ctypes.RTLD_LOCAL | getattr(os, 'RTLD_NOW', 0)
+
+LOADED_LIB_CACHE = None
+
+# reused across calls, call_lib grows it when a response doesn't fit
+RESULT_BUFFER = ctypes.create_string_buffer(64 * 1024)
+
+
+def get_lib():
+    global LOADED_LIB_CACHE
+    if LOADED_LIB_CACHE == None:
+        # resolve every symbol at load time
+        rust_lib = ctypes.CDLL(LIB_PATH, mode=LIB_LOAD_MODE)
+        rust_lib.call_command.argtypes = [
+            ctypes.c_char_p, ctypes.c_size_t, ctypes.POINTER(ctypes.c_char), ctypes.c_size_t]
+        rust_lib.call_command.restype = ctypes.c_size_t
+        rust_lib.read_last_result.argtypes = [
+            ctypes.POINTER(ctypes.c_char), ctypes.c_size_t]
+        rust_lib.read_last_result.restype = ctypes.c_size_t
+        LOADED_LIB_CACHE = rust_lib
+
+    return LOADED_LIB_CACHE
+
+
+def command_payload(template, *values):
+    return template % tuple(json_dumps(value) for value in values)
+
+
+def call_lib(payload):
+    global RESULT_BUFFER
+    lib = get_lib()
+    result_len = lib.call_command(
+        payload, len(payload), RESULT_BUFFER, len(RESULT_BUFFER))
+    if result_len > len(RESULT_BUFFER):
+        # the response didn't fit, grow the buffer and read the rest
+        RESULT_BUFFER = ctypes.create_string_buffer(result_len)
+        lib.read_last_result(RESULT_BUFFER, result_len)
+    return json_loads(ctypes.string_at(RESULT_BUFFER, result_len))